@@ -8,10 +8,41 @@ Purpose: Synchronize the audcast directory on a computer with an audio player
 """
 
 import os
+import sys
+import stat
+import errno
+import fcntl
 import shutil
 import logging
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+log = logging.getLogger(__name__)
+# bound once; used on the validation & out-of-space paths
+_warn = log.warning
+
+# number of files copied at the same time
+_COPY_WORKERS = 4
+
+# bytes requested per copy_file_range() call
+_KCOPY_CHUNK = 1 << 30
+
+# bytes per read() when no in-kernel copy is available
+_READ_CHUNK = 1 << 20
+
+# FAT-formatted players store mtimes in 2 second steps
+_MTIME_TOLERANCE_NS = 2 * 10**9
+
+# ioctl cloning a whole file's extents: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+# skip access-time updates on reads (Linux only)
+_O_NOATIME = getattr(os, 'O_NOATIME', 0)
+
+# record of copied files, so unchanged files on the player need no stat
+_COPY_DB_PATH = Path('~/.cache/synchro_audcasts/copied.txt').expanduser()
 
 
 class Synchronizer(object):
@@ -43,68 +74,48 @@ class Synchronizer(object):
     def validate_paths(self):
         """check that paths exist and target is mounted
         Return: t/f"""
-        logging.debug('checking that all paths exists')
-        # host exists?
-        self._path_host = Path(self.hostpath).expanduser()
-        assert isinstance(self._path_host, Path)
-        if not _path_validator(self._path_host,
-                               'Host path (%s) does not exist'):
-            return False
-
-        # host archive exists?
-        self._path_host_archive = Path(self.hostarchive).expanduser()
-        assert isinstance(self._path_host_archive, Path)
-        if not _path_validator(self._path_host_archive,
-                               'Host archive path (%s) does not exist'):
-            return False
-        
-        # player mount exists?
-        self._path_playermount = Path(self.playermount).expanduser()
-        assert isinstance(self._path_playermount, Path)
-        if not _path_validator(self._path_playermount,
-                               'Target mount path (%s) does not exist'):
-            return False
-        
-        # player mount is mounted?
-        if not os.path.ismount(self._path_playermount):
-            logging.warning('Target mount path (%s) is not mounted',
-                         self._path_playermount.absolute())
-            return False
-        
-        # player path exists?
-        self._path_playerpath = Path(self.playerpath).expanduser()
-        assert isinstance(self._path_playerpath, Path)
-        if not _path_validator(self._path_playerpath,
-                               'Target path (%s) does not exist'):
-            return False
+        log.debug('checking that all paths exists')
+        # (source attribute, validated attribute, warning), checked in order
+        specs = [
+            ('hostpath', '_path_host',
+             'Host path (%s) does not exist'),
+            ('hostarchive', '_path_host_archive',
+             'Host archive path (%s) does not exist'),
+            ('playermount', '_path_playermount',
+             'Target mount path (%s) does not exist'),
+            ('playerpath', '_path_playerpath',
+             'Target path (%s) does not exist'),
+            ('playerpatharchive', '_path_playerpath_archive',
+             'Player archive path (%s) does not exist'),
+            ('playerpathdelete', '_path_playerpath_delete',
+             'Player delete path (%s) does not exist'),
+        ]
+        for src, dst, message in specs:
+            p = Path(getattr(self, src)).expanduser()
+            if not _path_validator(p, message):
+                return False
+            setattr(self, dst, p)
 
-        # player archive path exists?
-        self._path_playerpath_archive = Path(self.playerpatharchive).expanduser()
-        assert isinstance(self._path_playerpath_archive, Path)
-        if not _path_validator(self._path_playerpath_archive,
-                               'Player archive path (%s) does not exist'):
-            return False
-        
-        # player delete path exists?
-        self._path_playerpath_delete = Path(self.playerpathdelete).expanduser()
-        assert isinstance(self._path_playerpath_delete, Path)
-        if not _path_validator(self._path_playerpath_delete,
-                               'Player delete path (%s) does not exist'):
-            return False
+            # player mount is mounted?
+            if dst == '_path_playermount' and not os.path.ismount(p):
+                _warn('Target mount path (%s) is not mounted',
+                      p.absolute())
+                return False
         
         return True
     
-    def run(self, debug=False):
+    def run(self, debug=False, sync=False):
         """
         Run the entire process
+        sync: flush all writes to disk once, after every file is handled
         """
         # set logging level
         if debug:
-            logging.getLogger().setLevel(logging.DEBUG)
+            log.setLevel(logging.DEBUG)
         
         # validate all paths
         if not self.validate_paths():
-            logging.warning('Path validation failed; aborting')
+            _warn('Path validation failed; aborting')
             return False
         
         # prep counts
@@ -112,90 +123,408 @@ class Synchronizer(object):
         count_deleted_files = 0
         count_copied_files = 0
         
-        # for all files in playerpatharchive, move to host
-        for p in self._path_playerpath_archive.iterdir():
-            if not (p.is_file() and not p.is_symlink()):
-                continue
-            # is this in host? if so, move
-            host_archive_candidate = Path(self._path_host, 
-                                          p.name)
-            logging.debug('Will archive %s',
-                          host_archive_candidate.absolute())
-            if not debug:
-                print('ARCHIVE %s' % p.name)
-                if host_archive_candidate.exists():
-                    # move on host; remove from player
-                    shutil.move(str(host_archive_candidate), str(self._path_host_archive))
-                    p.unlink()
-                else:
-                    # player has an archived file that doesn't exist on host
-                    shutil.move(str(p), str(self._path_host_archive))
-                    
-            count_archived_files += 1
-        
-        # for all files in playerpath/delete, delete from host
+        # list all directories concurrently; the actions below
+        # stay sequential
         path_player_delete = Path(self._path_playerpath, 'delete')
-        for p in path_player_delete.iterdir():
-            if not (p.is_file() and not p.is_symlink()):
-                continue
-            path_host_to_remove = Path(self._path_host, p.name)
-            if path_host_to_remove.exists():
-                logging.debug('Will remove %s', 
-                              path_host_to_remove.absolute())
-                if not debug:
-                    path_host_to_remove.unlink()
-                
-            if not debug:
-                print('REMOVE %s' % p)
-                p.unlink()
-            count_deleted_files += 1
-            
-        # for all files in host, verify they exist in target
-        for p in self._path_host.iterdir():
-            if not (p.is_file() and not p.is_symlink()):
-                continue
-            path_player = Path(self._path_playerpath, p.name)
-            if not path_player.exists():
-                if not _space_checker(self._path_playermount,
-                                      p):
-                    logging.warning('Not enough space for %s; aborting',
-                                 p.absolute())
+        with ThreadPoolExecutor(4) as executor:
+            archive_entries = executor.submit(_list_files,
+                                              self._path_playerpath_archive)
+            delete_entries = executor.submit(_list_files, path_player_delete)
+            host_entries = executor.submit(_list_files, self._path_host)
+            # every name in player, for existence checks
+            player_listing = executor.submit(os.listdir,
+                                             self._path_playerpath)
+
+            archive_files, _ = archive_entries.result()
+            delete_files, _ = delete_entries.result()
+            host_files, host_names = host_entries.result()
+            player_names = set(player_listing.result())
+
+        # checked once, so disabled debug messages cost nothing per file
+        debug_log = log.isEnabledFor(logging.DEBUG)
+
+        # plain string prefixes keep Path objects out of the loops below
+        host_base = str(self._path_host) + os.sep
+        player_base = os.path.abspath(str(self._path_playerpath)) + os.sep
+
+        # open every directory touched below once; per-file calls then
+        # resolve just the name relative to it
+        dir_fds = {}
+        try:
+            for path in (self._path_host, self._path_host_archive,
+                         self._path_playerpath, self._path_playerpath_archive,
+                         path_player_delete):
+                if path not in dir_fds:
+                    dir_fds[path] = _open_read(str(path), os.O_DIRECTORY)
+            host_fd = dir_fds[self._path_host]
+            host_archive_fd = dir_fds[self._path_host_archive]
+            player_fd = dir_fds[self._path_playerpath]
+            player_archive_fd = dir_fds[self._path_playerpath_archive]
+            player_delete_fd = dir_fds[path_player_delete]
+
+            # for all files in playerpatharchive, move to host
+            messages = []
+            try:
+                for entry in archive_files:
+                    name = entry.name
+                    # is this in host? if so, move
+                    if debug_log:
+                        log.debug('Will archive %s',
+                                  Path(host_base + name).absolute())
+                    if not debug:
+                        messages.append('ARCHIVE %s' % name)
+                        if name in host_names:
+                            # move on host; remove from player
+                            _fast_move(name, self._path_host,
+                                       self._path_host_archive,
+                                       host_fd, host_archive_fd)
+                            host_names.discard(name)
+                            os.unlink(name, dir_fd=player_archive_fd)
+                        else:
+                            # player has an archived file that doesn't exist on host
+                            _fast_move(name, self._path_playerpath_archive,
+                                       self._path_host_archive,
+                                       player_archive_fd, host_archive_fd)
+
+                    count_archived_files += 1
+            finally:
+                # report what was done, even if a move failed
+                _write_lines(messages)
+
+            # for all files in playerpath/delete, delete from host;
+            # queue the removals, then unlink them in a single pass
+            pending_unlinks = []
+            messages = []
+            try:
+                for entry in delete_files:
+                    name = entry.name
+                    if name in host_names:
+                        if debug_log:
+                            log.debug('Will remove %s',
+                                      Path(host_base + name).absolute())
+                        if not debug:
+                            pending_unlinks.append((host_fd, name))
+                            host_names.discard(name)
+
+                    if not debug:
+                        messages.append('REMOVE %s' % entry.path)
+                        pending_unlinks.append((player_delete_fd, name))
+                    count_deleted_files += 1
+
+                _unlink_files(pending_unlinks)
+            finally:
+                _write_lines(messages)
+
+            # for all files in host, verify they exist & are current in
+            # target; queue missing or stale files, then copy them
+            pending_copies = []
+            # free space only shrinks during a run, so read it once and
+            # subtract each queued copy
+            bytes_remaining = _bytes_available(self._path_playermount)
+            # files copied by an earlier run, keyed by player path
+            copy_db = _load_copy_db()
+            for entry in host_files:
+                name = entry.name
+                if name not in host_names:
+                    continue
+                path_player = player_base + name
+                statinfo = entry.stat(follow_symlinks=False)
+                file_key = (statinfo.st_size, statinfo.st_mtime_ns)
+                # size of a stale player copy, freed when it is overwritten
+                old_size = 0
+                if name in player_names:
+                    if copy_db.get(path_player) == file_key:
+                        # copied by an earlier run & unchanged on host
+                        # since; spares the stat of the player's copy
+                        continue
+                    current, old_size = _is_current(statinfo, name,
+                                                    player_fd)
+                    if current:
+                        continue
+                # check for space, including files already queued
+                file_size = statinfo.st_size
+                if bytes_remaining + old_size < file_size:
+                    _warn('Not enough space for %s; aborting',
+                          Path(entry.path).absolute())
                     break
-                logging.debug("Will copy %s", p.name)
-                # check for space
-                if not debug:
-                    print("COPY %s" % p.name)
-                    shutil.copy(str(p), str(path_player))
+                if debug_log:
+                    log.debug("Will copy %s", name)
+                pending_copies.append((name, name, file_size))
+                player_names.add(name)
+                copy_db[path_player] = file_key
+                bytes_remaining -= file_size - old_size
                 count_copied_files += 1
+
+            if not debug:
+                _copy_files(pending_copies, host_fd, player_fd)
+        finally:
+            for dir_fd in dir_fds.values():
+                os.close(dir_fd)
+
+        if not debug:
+            if sync:
+                # one flush for the whole run instead of one per file
+                log.debug('Flushing writes to disk')
+                os.sync()
+            # forget this player's files that are no longer on host
+            player_dir = os.path.abspath(str(self._path_playerpath))
+            try:
+                _save_copy_db({key: value for key, value in copy_db.items()
+                               if os.path.dirname(key) != player_dir
+                               or os.path.basename(key) in host_names})
+            except OSError as exc:
+                # the record is only a cache; the sync itself succeeded
+                _warn('Could not save copy record (%s)', exc)
         
-        logging.info('Archived %s files, removed %s files, copied %s files', 
-                     count_archived_files,
-                     count_deleted_files,
-                     count_copied_files)
+        log.info('Archived %s files, removed %s files, copied %s files',
+                 count_archived_files,
+                 count_deleted_files,
+                 count_copied_files)
         
         return True
 
     
-def _space_checker(mount_to_check, file_to_check):
-    """given a mount point and a file, check if the mount point has enough
-    space for the given file
-    Returns t/f"""
+def _unlink_files(pending_unlinks):
+    """unlink every queued (directory fd, name) entry"""
+    for dir_fd, name in pending_unlinks:
+        os.unlink(name, dir_fd=dir_fd)
+
+
+def _fast_move(name, src_dir, dst_dir, src_dir_fd, dst_dir_fd):
+    """move name from src_dir into dst_dir without copying data where
+    possible: a rename on the same filesystem, a reflink clone across
+    filesystems that share extents (e.g. btrfs subvolumes), otherwise
+    shutil.move (copy & delete)
+    src_dir_fd/dst_dir_fd: open descriptors of src_dir & dst_dir"""
+    try:
+        # shutil.move refuses to overwrite; keep that behaviour
+        os.stat(name, dir_fd=dst_dir_fd, follow_symlinks=False)
+        dst_exists = True
+    except FileNotFoundError:
+        dst_exists = False
+    if not dst_exists:
+        try:
+            os.rename(name, name,
+                      src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+            return
+        except PermissionError:
+            try:
+                os.link(name, name,
+                        src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+                os.unlink(name, dir_fd=src_dir_fd)
+                return
+            except OSError:
+                pass
+        except OSError as exc:
+            if (exc.errno == errno.EXDEV
+                    and _reflink(name, src_dir_fd, dst_dir_fd)):
+                os.unlink(name, dir_fd=src_dir_fd)
+                return
+    shutil.move(os.path.join(str(src_dir), name), str(dst_dir))
+
+
+def _reflink(name, src_dir_fd, dst_dir_fd):
+    """clone name from src_dir_fd into dst_dir_fd with the FICLONE ioctl,
+    sharing extents instead of copying data; permission bits & times are
+    copied as with shutil.copy2
+    Returns t/f; on failure nothing is left behind in dst_dir_fd"""
+    fd_src = _open_read(name, dir_fd=src_dir_fd)
+    try:
+        fd_dst = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o666, dir_fd=dst_dir_fd)
+        try:
+            fcntl.ioctl(fd_dst, _FICLONE, fd_src)
+            statinfo = os.fstat(fd_src)
+            os.fchmod(fd_dst, stat.S_IMODE(statinfo.st_mode))
+            os.utime(fd_dst, ns=(statinfo.st_atime_ns, statinfo.st_mtime_ns))
+        except OSError:
+            # not supported by this filesystem pair
+            os.close(fd_dst)
+            os.unlink(name, dir_fd=dst_dir_fd)
+            return False
+        os.close(fd_dst)
+    finally:
+        os.close(fd_src)
+    return True
+
+
+def _load_copy_db(db_path=None):
+    """read the record of files copied by earlier runs
+    Returns: dict of player path -> (size, mtime_ns)"""
+    db_path = db_path or _COPY_DB_PATH
+    copy_db = {}
+    try:
+        with open(str(db_path), encoding='utf-8') as db_file:
+            for line in db_file:
+                try:
+                    path_player, size, mtime_ns = line.rstrip('\n').rsplit('\t', 2)
+                    copy_db[path_player] = (int(size), int(mtime_ns))
+                except ValueError:
+                    log.debug('Skipping malformed copy record %r', line)
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        # the record is only a cache; run without it
+        _warn('Could not read copy record (%s)', exc)
+    return copy_db
+
+
+def _save_copy_db(copy_db, db_path=None):
+    """write the record of copied files, replacing the previous one"""
+    db_path = db_path or _COPY_DB_PATH
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = db_path.with_name(db_path.name + '.tmp')
+    with open(str(path_tmp), 'w', encoding='utf-8') as db_file:
+        for path_player, (size, mtime_ns) in sorted(copy_db.items()):
+            if '\n' in path_player:
+                continue
+            db_file.write('%s\t%d\t%d\n' % (path_player, size, mtime_ns))
+    os.replace(str(path_tmp), str(db_path))
+
+
+def _is_current(statinfo_src, name, dst_dir_fd):
+    """check whether name in dst_dir_fd matches the source's size & mtime;
+    mtimes within _MTIME_TOLERANCE_NS are treated as equal, and anything
+    other than a regular file (directory, symlink, ...) is left alone
+    Returns: (t/f, size of the existing regular file or 0)"""
+    try:
+        statinfo_dst = os.stat(name, dir_fd=dst_dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        return False, 0
+    if not stat.S_ISREG(statinfo_dst.st_mode):
+        return True, 0
+    current = (statinfo_dst.st_size == statinfo_src.st_size
+               and abs(statinfo_dst.st_mtime_ns - statinfo_src.st_mtime_ns)
+               < _MTIME_TOLERANCE_NS)
+    return current, statinfo_dst.st_size
+
+
+def _list_files(path_to_list):
+    """list regular (non-symlink) files in a directory, in one readdir
+    Returns: (list of os.DirEntry, set of every entry's name)"""
+    files = []
+    names = set()
+    with os.scandir(path_to_list) as it:
+        for entry in it:
+            names.add(entry.name)
+            if entry.is_file(follow_symlinks=False):
+                files.append(entry)
+    return files, names
+
+
+def _bytes_available(mount_to_check):
+    """given a mount point, return the bytes available to unprivileged
+    users"""
     statinfo = os.statvfs(mount_to_check)
     
     block_size = statinfo.f_frsize
     available_blocks = statinfo.f_bavail
-    bytes_available = block_size * available_blocks
     
-    file_size = Path(file_to_check).stat().st_size
-    
-    return bytes_available >= file_size
+    return block_size * available_blocks
+
+
+def _copy_files(pending_copies, src_dir_fd=None, dst_dir_fd=None):
+    """copy every queued (source, destination, size) entry, several files
+    at a time; relative names are resolved against src_dir_fd/dst_dir_fd"""
+    with ThreadPoolExecutor(_COPY_WORKERS) as executor:
+        copies = [executor.submit(_kcopy, src, dst, src_dir_fd, dst_dir_fd)
+                  for src, dst, _ in pending_copies]
+    # report only the copies that succeeded, then re-raise the first failure
+    _write_lines(["COPY %s" % os.path.basename(src)
+                  for (src, _, _), copy in zip(pending_copies, copies)
+                  if copy.exception() is None])
+    for copy in copies:
+        copy.result()
+
+
+def _open_read(path, flags=0, dir_fd=None):
+    """open path read-only without updating its access time, where the
+    platform & file ownership allow it
+    Returns: file descriptor"""
+    flags |= os.O_RDONLY | os.O_CLOEXEC
+    if _O_NOATIME:
+        try:
+            return os.open(path, flags | _O_NOATIME, dir_fd=dir_fd)
+        except PermissionError:
+            # O_NOATIME is only allowed on files we own
+            pass
+    return os.open(path, flags, dir_fd=dir_fd)
+
+
+def _kcopy(src, dst, src_dir_fd=None, dst_dir_fd=None):
+    """copy src to dst inside the kernel, without bouncing the data through
+    user-space buffers; permission bits & times are copied as with
+    shutil.copy2"""
+    fd_src = _open_read(str(src), dir_fd=src_dir_fd)
+    try:
+        # never write through a symlink on the player
+        fd_dst = os.open(str(dst),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW,
+                         0o666, dir_fd=dst_dir_fd)
+        try:
+            statinfo = os.fstat(fd_src)
+            copied = 0
+            done = False
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while True:
+                        sent = os.copy_file_range(fd_src, fd_dst, _KCOPY_CHUNK)
+                        if sent == 0:
+                            break
+                        copied += sent
+                    # some filesystems report 0 before the end of the file
+                    done = copied == statinfo.st_size
+                except OSError:
+                    # e.g. cross-filesystem on older kernels
+                    pass
+            if not done and hasattr(os, 'sendfile'):
+                # sendfile carries on from the current offsets
+                try:
+                    while copied < statinfo.st_size:
+                        sent = os.sendfile(fd_dst, fd_src, None,
+                                           statinfo.st_size - copied)
+                        if sent == 0:
+                            break
+                        copied += sent
+                    done = copied == statinfo.st_size
+                except OSError:
+                    # e.g. macOS & BSD only send to sockets
+                    pass
+            if not done:
+                # plain read/write, again from the current offsets
+                while copied < statinfo.st_size:
+                    data = os.read(fd_src, _READ_CHUNK)
+                    if not data:
+                        break
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd_dst, view):]
+                    copied += len(data)
+            if copied != statinfo.st_size:
+                raise OSError(errno.EIO,
+                              'Short copy (%d of %d bytes)'
+                              % (copied, statinfo.st_size), str(src))
+            os.fchmod(fd_dst, stat.S_IMODE(statinfo.st_mode))
+            # keep host times, so the next run sees the copy as current
+            os.utime(fd_dst, ns=(statinfo.st_atime_ns, statinfo.st_mtime_ns))
+        finally:
+            os.close(fd_dst)
+    finally:
+        os.close(fd_src)
     
 
+def _write_lines(lines):
+    """write lines to stdout with a single write & flush"""
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+
 def _path_validator(path_to_check, warning_message):
     """checks for existing Path()
     Returns t/f"""
     if not path_to_check.exists():
-        logging.warning(warning_message, path_to_check.absolute())
+        _warn(warning_message, path_to_check.absolute())
         return False
     return True
     
@@ -225,6 +554,10 @@ def run():
                       dest="debug",
                       action="store_true",
                       help="debug mode (NO filesystem changes)")
+    parser.add_argument("--sync",
+                      dest="sync",
+                      action="store_true",
+                      help="flush all writes to disk once at the end")
     parser.add_argument("-v", "--verbose",
                       action="store_true", dest="verbose")
     args = parser.parse_args()
@@ -232,7 +565,7 @@ def run():
     synchro = Synchronizer(args.host, args.host_archive, 
                            args.player_mount, args.player_path, 
                            args.player_archive, args.player_delete,)
-    synchro.run(args.debug)
+    synchro.run(args.debug, args.sync)
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,154 @@
+"""
+Tests for synchro_audcasts
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import synchro_audcasts
+
+
+class SyncTestCase(unittest.TestCase):
+    """host & player directories in a temporary tree"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        for name in ('host', 'host_archive', 'player/archive',
+                     'player/delete'):
+            Path(self.root, name).mkdir(parents=True)
+        patcher = mock.patch.object(synchro_audcasts, '_COPY_DB_PATH',
+                                    Path(self.root, 'copied.txt'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, name, size, mtime=None):
+        path = Path(self.root, name)
+        path.write_bytes(b'x' * size)
+        if mtime is not None:
+            os.utime(str(path), (mtime, mtime))
+        return path
+
+    def _synchronizer(self):
+        return synchro_audcasts.Synchronizer(
+            str(Path(self.root, 'host')), str(Path(self.root, 'host_archive')),
+            '/', str(Path(self.root, 'player')),
+            str(Path(self.root, 'player/archive')),
+            str(Path(self.root, 'player/delete')))
+
+    def _run(self, bytes_available):
+        synchro = self._synchronizer()
+        with mock.patch.object(synchro_audcasts, '_bytes_available',
+                               return_value=bytes_available), \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertTrue(synchro.run())
+        return out.getvalue()
+
+
+class RecopyTest(SyncTestCase):
+    """re-copying stale player files"""
+
+    def test_stale_copy_space_is_credited(self):
+        """the space of the overwritten copy counts towards the new one"""
+        self._write('host/big.mp3', 1000)
+        self._write('host/new.mp3', 100)
+        self._write('player/big.mp3', 900, mtime=0)
+
+        out = self._run(500)
+
+        self.assertIn('COPY big.mp3', out)
+        self.assertIn('COPY new.mp3', out)
+        self.assertEqual(Path(self.root, 'player/big.mp3').stat().st_size,
+                         1000)
+        self.assertTrue(Path(self.root, 'player/new.mp3').exists())
+
+    def test_stale_copy_without_space_aborts(self):
+        """a re-copy still needs room for the size difference"""
+        self._write('host/big.mp3', 1000)
+        self._write('player/big.mp3', 100, mtime=0)
+
+        out = self._run(500)
+
+        self.assertNotIn('COPY big.mp3', out)
+        self.assertEqual(Path(self.root, 'player/big.mp3').stat().st_size,
+                         100)
+
+    def test_current_copy_is_skipped(self):
+        """a player copy with matching size & mtime is left alone"""
+        host_file = self._write('host/same.mp3', 100)
+        mtime = host_file.stat().st_mtime
+        self._write('player/same.mp3', 100, mtime=mtime)
+
+        out = self._run(500)
+
+        self.assertNotIn('COPY same.mp3', out)
+
+
+class CopyRecordTest(SyncTestCase):
+    """the record of copied files"""
+
+    def test_unusable_record_does_not_fail_run(self):
+        """a record that cannot be read or saved only warns"""
+        self._write('host/new.mp3', 100)
+        # a regular file where the record's directory should be
+        self._write('blocker', 1)
+        with mock.patch.object(synchro_audcasts, '_COPY_DB_PATH',
+                               Path(self.root, 'blocker', 'copied.txt')), \
+                self.assertLogs(synchro_audcasts.log, 'WARNING') as logs:
+            out = self._run(500)
+
+        self.assertIn('COPY new.mp3', out)
+        self.assertTrue(any('Could not save copy record' in line
+                            for line in logs.output))
+
+
+class ReportTest(SyncTestCase):
+    """ARCHIVE/REMOVE/COPY lines"""
+
+    def test_failed_archive_is_reported(self):
+        """lines buffered before a failing move are still written"""
+        self._write('host/old.mp3', 100)
+        self._write('player/archive/old.mp3', 100)
+        # already archived on host, so the move refuses to overwrite it
+        self._write('host_archive/old.mp3', 100)
+        synchro = self._synchronizer()
+
+        with contextlib.redirect_stdout(io.StringIO()) as out, \
+                self.assertRaises(shutil.Error):
+            synchro.run()
+
+        self.assertIn('ARCHIVE old.mp3', out.getvalue())
+
+    def test_failed_copy_is_not_reported(self):
+        """COPY is written only for copies that succeeded"""
+        self._write('host/good.mp3', 100)
+        self._write('host/bad.mp3', 100)
+        kcopy = synchro_audcasts._kcopy
+
+        def failing_kcopy(src, dst, *args):
+            if src == 'bad.mp3':
+                raise OSError('copy failed')
+            kcopy(src, dst, *args)
+
+        synchro = self._synchronizer()
+        with mock.patch.object(synchro_audcasts, '_kcopy', failing_kcopy), \
+                contextlib.redirect_stdout(io.StringIO()) as out, \
+                self.assertRaises(OSError):
+            synchro.run()
+
+        self.assertIn('COPY good.mp3', out.getvalue())
+        self.assertNotIn('COPY bad.mp3', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()